@@ -6,79 +6,255 @@ This module contains functions to use in AWS for performing security operations.
 
 import boto3
 import botocore.session
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
-import json
+import logging
+import orjson
 
-def evaluate_s3_public_access (bucket_name):
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Client configuration shared by the clients in this module.
+# The connection pool is sized above the number of worker threads used to evaluate buckets in parallel so threads never wait for a free connection (the botocore default is 10).
+# Adaptive retries throttle the client when S3 starts returning 503 SlowDown under concurrent load.
+CLIENT_CONFIG = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+# Amazon S3 considers a bucket or object ACL public if it grants any permissions to members of the predefined AllUsers or AuthenticatedUsers groups.
+# See The meaning of "Public" section here: https://docs.aws.amazon.com/AmazonS3/latest/userguide/access-control-block-public-access.html
+_PUBLIC_GROUP_URIS = frozenset({
+    'http://acs.amazonaws.com/groups/global/AllUsers',
+    'http://acs.amazonaws.com/groups/global/AuthenticatedUsers'
+})
+
+# S3 Block Public Access settings. When all of them are enabled no ACL or bucket policy can make a bucket public.
+# See https://docs.aws.amazon.com/AmazonS3/latest/userguide/access-control-block-public-access.html
+_PUBLIC_ACCESS_BLOCK_SETTINGS = ('BlockPublicAcls', 'IgnorePublicAcls', 'BlockPublicPolicy', 'RestrictPublicBuckets')
+
+@dataclass(slots=True)
+class BucketPublicAccess:
+    '''
+    Description: Properties of an S3 bucket that determine whether the bucket is public due to Access Control List (ACL) or bucket policy.
+    Returned by evaluate_s3_public_access(). Slotted, so a large audit holds no per-bucket dictionary and attributes are read without hashing.
+    Attributes:
+    - name: the name of the S3 bucket.
+    - owner: the Owner dictionary of the bucket ACL, or None if the ACL could not be read.
+    - grants: the list of Grants of the bucket ACL, or None if the ACL could not be read.
+    - policy_status: the PolicyStatus dictionary of the bucket, 'NOT_APPLICABLE' if the bucket does not have a bucket policy, or None if it could not be read.
+    - public_acl: True if the bucket is public due to ACL, False if it is not, None if the ACL could not be read.
+    - public_policy: True if the bucket is public due to bucket policy, False if it is not, None if there is no policy or it could not be read.
+    - public_access_block: the PublicAccessBlockConfiguration dictionary of the bucket, or None if the bucket does not have one or it could not be read.
+    '''
+    name: str
+    owner: dict | None = None
+    grants: list | None = None
+    policy_status: dict | str | None = None
+    public_acl: bool | None = None
+    public_policy: bool | None = None
+    public_access_block: dict | None = None
+
+    def as_dict(self):
+        '''
+        Description: Returns the properties as a dictionary keyed like the S3 API responses (Name, Owner, Grants, PolicyStatus, PublicACL, PublicPolicy, PublicAccessBlock).
+        '''
+        return {
+            'Name': self.name,
+            'Owner': self.owner,
+            'Grants': self.grants,
+            'PolicyStatus': self.policy_status,
+            'PublicACL': self.public_acl,
+            'PublicPolicy': self.public_policy,
+            'PublicAccessBlock': self.public_access_block
+        }
+
+    def is_conclusive(self):
+        '''
+        Description: Returns True if the evaluation settled whether the bucket is public: either the bucket's Block Public Access configuration blocks all public access,
+        or both the ACL and the policy status were read ('NOT_APPLICABLE' counts as read). Returns False if any of them could not be read, e.g. because of throttling or AccessDenied.
+        '''
+        if self.public_access_block is not None and _blocks_public_access(self.public_access_block):
+            return True
+        return self.public_acl is not None and self.policy_status is not None
+
+@lru_cache(maxsize=None)
+def _get_client(service_name, region_name=None):
+    '''
+    Description: Returns a client for the given service and region, built once and reused on every subsequent call. All the clients of this module are built here.
+    Building a client loads and parses the service model, which costs tens of milliseconds, so it should not be done once per bucket.
+    Low-level clients are thread-safe and can be shared by worker threads, see https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
+    '''
+    return boto3.client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+
+def get_s3_client(region_name=None):
+    '''
+    Description: Returns the S3 client for the given region, built once and reused on every subsequent call.
+    Parameters:
+    - region_name: optional name of the AWS region. If omitted the default region of the environment is used.
+    '''
+    return _get_client('s3', region_name)
+
+def account_blocks_public_access(account_id=None):
+    '''
+    Description: Returns True if S3 Block Public Access is fully enabled at the account level, in which case no bucket of the account can be public
+    and the per-bucket evaluation can be skipped. Returns False if any setting is disabled, the account has no Block Public Access configuration, or it could not be read.
+    Parameters:
+    - account_id: optional ID of the AWS account. If omitted the account of the current credentials is used.
+    Examples:
+    if account_blocks_public_access():
+        print('No bucket in this account can be public.')
+    '''
+    # S3 Control has no global endpoint, so its client needs a region even when none is configured. The S3 client always resolves one.
+    region_name = get_s3_client().meta.region_name
+
+    try:
+        if account_id is None:
+            account_id = _get_client('sts', region_name).get_caller_identity()['Account']
+
+        public_access_block = _get_client('s3control', region_name).get_public_access_block(AccountId=account_id)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
+            logger.debug("Account %s does not have a Block Public Access configuration.", account_id)
+        else:
+            logger.error("Unexpected error: %s", e.response)
+        return False
+    except BotoCoreError as e:
+        # E.g. no region or no endpoint could be resolved, or the endpoint could not be reached. The buckets are then evaluated one by one.
+        logger.warning("Could not read the account Block Public Access configuration: %s", e)
+        return False
+
+    return _blocks_public_access(public_access_block['PublicAccessBlockConfiguration'])
+
+def _blocks_public_access(configuration):
+    '''
+    Description: Returns True if all the settings of a PublicAccessBlockConfiguration dictionary are enabled.
+    '''
+    return all(configuration.get(setting, False) for setting in _PUBLIC_ACCESS_BLOCK_SETTINGS)
+
+def evaluate_s3_public_access (bucket_name, s3_client=None):
     '''
-    Description: Returns relevant properties of an S3 bucket that determine whether the bucket is public due to Access Control List (ACL) or bucket policy.
+    Description: Returns a BucketPublicAccess with the relevant properties of an S3 bucket that determine whether the bucket is public due to Access Control List (ACL) or bucket policy.
+    The bucket's Block Public Access configuration is read first: if all its settings are enabled neither ACL nor bucket policy can make the bucket public,
+    so the bucket is reported as not public without reading its ACL and policy status.
     Parameters:
     - bucket_name: the name of the S3 bucket to be evaluated for public access.
+    - s3_client: optional S3 client used for the API calls. If omitted the client returned by get_s3_client() is used.
     Examples:
     # Call the function for the bucket to be evaluated.
     my_bucket_properties=evaluate_s3_public_access(bucket_name='my-bucket')
     
     # Test if the bucket is public due to ACL or bucket policy.
-    if my_bucket_properties['PublicACL'] or my_bucket_properties['PublicPolicy']:
+    if my_bucket_properties.public_acl or my_bucket_properties.public_policy:
         print('The bucket my-bucket is public.')
     else:
         print('The bucket my-bucket is not public.')
     '''
-    s3 = boto3.client('s3')
+    s3 = s3_client or get_s3_client()
 
-    public_acl=None
-    public_policy = None
-    bucket_properties = {'Name':bucket_name, 'Grants':'Some grants'}
-    
-    # Get bucket ACL.
-    try:
-        bucket_acl = s3.get_bucket_acl(Bucket=bucket_name)
-    
-        bucket_properties['Owner']=bucket_acl['Owner']
-        bucket_properties['Grants']=bucket_acl['Grants']
-    
-        # Amazon S3 considers a bucket or object ACL public if it grants any permissions to members of the predefined AllUsers or AuthenticatedUsers groups.
-        # See The meaning of "Public" section here: https://docs.aws.amazon.com/AmazonS3/latest/userguide/access-control-block-public-access.html 
-        for grant in bucket_acl['Grants']:
-            if grant['Grantee']['Type'] == 'Group':
-                if (grant['Grantee']['URI'] == 'http://acs.amazonaws.com/groups/global/AllUsers') or (grant['Grantee']['URI'] == 'http://acs.amazonaws.com/groups/global/AuthenticatedUsers') :
-                    public_acl = True
-            # if grant['Grantee']['Type'] is not 'Group' the bucket is not public by ACL.
-            else:
-                public_acl = False
+    bucket_properties = BucketPublicAccess(name=bucket_name)
 
+    # Get bucket Block Public Access configuration.
+    try:
+        bucket_properties.public_access_block = s3.get_public_access_block(Bucket=bucket_name)['PublicAccessBlockConfiguration']
     except botocore.exceptions.ClientError as e:
-        print("Unexpected error: %s" % (e.response))
+        if e.response['Error']['Code'] == 'NoSuchPublicAccessBlockConfiguration':
+            logger.debug("Bucket %s does not have a Block Public Access configuration.", bucket_name)
+        elif e.response['Error']['Code'] == 'AccessDenied':
+            # Without s3:GetBucketPublicAccessBlock the bucket is still evaluated from its ACL and policy status.
+            logger.debug("Access denied to the Block Public Access configuration of bucket %s.", bucket_name)
+        else:
+            logger.error("Unexpected error in GetPublicAccessBlock for bucket %s: %s", bucket_name, e.response)
 
-    # Get bucket policy status.
-    try:
-        bucket_policy_status = s3.get_bucket_policy_status(Bucket=bucket_name)
+    if bucket_properties.public_access_block is not None and _blocks_public_access(bucket_properties.public_access_block):
+        bucket_properties.public_acl = False
+        bucket_properties.public_policy = False
+        return bucket_properties
+
+    # The ACL and the policy status are independent, so the policy status is requested on a helper thread while the ACL is requested on this one.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        policy_status_future = executor.submit(s3.get_bucket_policy_status, Bucket=bucket_name)
+
+        # Get bucket ACL.
+        try:
+            bucket_acl = s3.get_bucket_acl(Bucket=bucket_name)
+        except botocore.exceptions.ClientError as e:
+            bucket_acl = None
+            logger.error("Unexpected error: %s", e.response)
+
+        # Get bucket policy status.
+        try:
+            bucket_policy_status = policy_status_future.result()
+        except botocore.exceptions.ClientError as e:
+            bucket_policy_status = None
+            if e.response['Error']['Code'] == 'NoSuchBucketPolicy':
+                logger.debug("Bucket %s does not have a bucket policy.", bucket_name)
+                bucket_properties.policy_status="NOT_APPLICABLE"
+            else:
+                logger.error("Unexpected error: %s", e.response)
+
+    if bucket_acl is not None:
+        bucket_properties.owner=bucket_acl['Owner']
+        bucket_properties.grants=bucket_acl['Grants']
     
-        bucket_properties['PolicyStatus']=bucket_policy_status['PolicyStatus']
+        # The bucket is public by ACL if any grant goes to one of the public groups. any() stops at the first public grant.
+        bucket_properties.public_acl = any(
+            grant['Grantee'].get('URI') in _PUBLIC_GROUP_URIS
+            for grant in bucket_acl['Grants']
+            if grant['Grantee'].get('Type') == 'Group'
+        )
+
+    if bucket_policy_status is not None:
+        bucket_properties.policy_status=bucket_policy_status['PolicyStatus']
     
-        public_policy = bucket_policy_status['PolicyStatus']['IsPublic']
+        bucket_properties.public_policy = bucket_policy_status['PolicyStatus']['IsPublic']
 
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchBucketPolicy':
-            print(f"Bucket {bucket_name} does not have a bucket policy.")
-            bucket_properties['PolicyStatus']="NOT_APPLICABLE"
-        else:
-            print("Unexpected error: %s" % (e.response))
+    return bucket_properties
 
+def iter_objects(bucket_name, prefix='', s3_client=None):
+    '''
+    Description: Yields the objects of an S3 bucket one by one, fetching them lazily with the list_objects_v2 paginator.
+    Each page holds up to 1000 objects, the maximum allowed by S3, to keep the number of round-trips low, and no list of all the objects is built in memory.
+    Parameters:
+    - bucket_name: the name of the S3 bucket to list.
+    - prefix: optional key prefix. Only objects whose key begins with prefix are listed.
+    - s3_client: optional S3 client used for the API calls. If omitted the client returned by get_s3_client() is used.
+    Examples:
+    for s3_object in iter_objects(bucket_name='my-bucket', prefix='logs/'):
+        print(s3_object['Key'], s3_object['Size'])
+    '''
+    s3 = s3_client or get_s3_client()
 
-    bucket_properties['PublicACL']=public_acl
-    bucket_properties['PublicPolicy']=public_policy
+    paginator = s3.get_paginator('list_objects_v2')
 
-    return bucket_properties
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        yield from page.get('Contents', [])
+
+def _dumps(obj):
+    '''
+    Description: Serializes obj to a JSON string. orjson returns bytes, which are decoded once here because the Google Sheets API expects strings.
+    '''
+    return orjson.dumps(obj).decode()
+
+@lru_cache(maxsize=64)
+def _dumps_owner(owner_id, display_name):
+    '''
+    Description: Serializes an S3 Owner to a JSON string. The buckets of an account usually share one or two owners, so the string is built once per owner and cached.
+    Parameters:
+    - owner_id: the canonical user ID of the owner.
+    - display_name: the display name of the owner, or None if the response did not include one.
+    '''
+    owner = {'ID': owner_id} if display_name is None else {'DisplayName': display_name, 'ID': owner_id}
+    return _dumps(owner)
 
 def serialize_bucket_properties(bucket_properties, mode):
     '''
-    Description: Uses json module to serialize a public_bucket_properties dictionary so they can be printed.
+    Description: Uses orjson module to serialize a BucketPublicAccess so it can be printed.
     Parameters:
-    - bucket_properties: Dictionary of dictonaries representing the properties of an S3 bucket returned by the evaluate_s3_public_access(bucket_name) function.
+    - bucket_properties: BucketPublicAccess representing the properties of an S3 bucket returned by the evaluate_s3_public_access(bucket_name) function.
     - mode: string with accepted values 'RAW' or 'NORMALIZED'. 
-        If mode = 'RAW' the whole bucket_properties dictionary is serialized to a flat string.
+        If mode = 'RAW' the whole bucket_properties.as_dict() dictionary is serialized to a flat string.
         If mode = 'NORMALIZED' the bucket's Name, PublicACL and PublicPolicy attributes are extracted and the Owner and Grants dictionaries are serialized. 
     TO-DO:
     -Introduce parameter validation for mode so that only RAW and NORMALIZED are accepted.
@@ -88,15 +264,16 @@ def serialize_bucket_properties(bucket_properties, mode):
 
     match mode:
         case 'RAW':
-            serialized_bucket_properties = [json.dumps(bucket_properties)]
+            serialized_bucket_properties = [_dumps(bucket_properties.as_dict())]
     
         case 'NORMALIZED':
+            owner = bucket_properties.owner
             serialized_bucket_properties = [
-                bucket_properties['Name'],
-                bucket_properties['PublicACL'],
-                bucket_properties['PublicPolicy'],
-                json.dumps(bucket_properties['Owner']),
-                json.dumps(bucket_properties['Grants'])
+                bucket_properties.name,
+                bucket_properties.public_acl,
+                bucket_properties.public_policy,
+                _dumps_owner(owner['ID'], owner.get('DisplayName')) if owner is not None else _dumps(None),
+                _dumps(bucket_properties.grants)
             ]
 
     return serialized_bucket_properties
@@ -1,5 +1,6 @@
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import datetime
 
 def create_google_sheet(service_account_key_path, folder_id, sheet_name):
@@ -20,14 +21,7 @@ def create_google_sheet(service_account_key_path, folder_id, sheet_name):
     # Create a Google Drive API client
     drive_service = build('drive', 'v3', credentials=credentials)
 
-    # Check if the specified folder_id exists
-    folder_exists = drive_service.files().get(fileId=folder_id).execute()
-
-    if not folder_exists:
-        print(f"Folder with ID {folder_id} not found.")
-        return None
-
-    # Create a new Google Sheet
+    # Create a new Google Sheet. There is no separate check that folder_id exists: the create call fails with 404 if the parent folder is not found.
     sheet_metadata = {
         'name': sheet_name,
         'mimeType': 'application/vnd.google-apps.spreadsheet',
@@ -43,6 +37,12 @@ def create_google_sheet(service_account_key_path, folder_id, sheet_name):
 
         # Return the ID of the created Google Sheet
         return sheet_id
+    except HttpError as e:
+        if e.resp.status == 404:
+            print(f"Folder with ID {folder_id} not found.")
+        else:
+            print("Error creating sheet:", e)
+        return None
     except Exception as e:
         print("Error creating sheet:", e)
         return None
@@ -2,51 +2,81 @@
 Example: How to flag the ingress rules that open remote access ports to the whole Internet.
 '''
 
+import logging
+
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-def flag_remote_access(groupId):
+from collections import defaultdict
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Keep the connections to the EC2 endpoint warm and retry adaptively when the API throttles.
+client_config = Config(max_pool_connections=64, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+# JMESPath filter that selects the ingress rules with either CidrIpv4 or CidrIpv6 range of anywhere that allow RDP (3389) or SSH (22) access.
+# PageIterator.search() applies it to every page and yields the matching rules one by one.
+_OFFENDING_INGRESS_RULES = (
+    "SecurityGroupRules[?IsEgress==`false`"
+    " && (CidrIpv4=='0.0.0.0/0' || CidrIpv6=='::/0')"
+    " && (FromPort==`22` || FromPort==`3389`)]"
+)
+
+@lru_cache(maxsize=None)
+def _get_ec2(region_name=None):
     '''
-    Description: Returns a list of ingress security rules that allow access to port 3389 (RDP)/22 (SSH) from anywhere.
+    Description: Returns an EC2 client for the given region, built once and reused so the connection pool persists across calls.
+    Low-level clients are thread-safe, see https://boto3.amazonaws.com/v1/documentation/api/latest/guide/clients.html#multithreading-or-multiprocessing-with-clients
     '''
+    return boto3.client('ec2', region_name=region_name, config=client_config)
+
+def flag_remote_access_bulk(group_ids=None):
+    '''
+    Description: Returns a dictionary that maps security group IDs to the list of their ingress security rules that allow access to port 3389 (RDP)/22 (SSH) from anywhere.
+    The rules of all the security groups are fetched with a single paginated describe_security_group_rules call instead of one call per security group.
+    Parameters:
+    - group_ids: optional list of security group IDs to evaluate. If omitted (None) all the security groups in the region are evaluated; an empty list evaluates none.
+    '''
+
+    # Only None selects all the security groups, so an empty list never widens the scan to the whole region.
+    if group_ids is None:
+        filters = []
+    else:
+        group_ids = list(group_ids)
+        if not group_ids:
+            return {}
+
+        # The group-id filter accepts many values, so all the security groups are requested at once.
+        filters = [{'Name': 'group-id', 'Values': group_ids}]
 
     # Get the client for the EC2 service.
-    ec2 = boto3.client('ec2')
+    ec2 = _get_ec2()
 
-    filters=[{'Name': 'group-id', 'Values': [groupId]}]
+    offending_ingress_rules = defaultdict(list)
 
-    print(f"Processing security group: {groupId}")
-    
     try:
-        response = ec2.describe_security_group_rules(Filters = filters)
+        paginator = ec2.get_paginator('describe_security_group_rules')
 
-        all_rules = response['SecurityGroupRules']
-    
-        offending_ingress_rules = []
-    
-        if all_rules != []:
-
-            for rule in all_rules:
-                # Only flag ingress rules 
-                if rule['IsEgress'] == False:
-                 
-                    print(f"Processing ingress rule: {rule['SecurityGroupRuleId']}")
-                    # with either CidrIpv4 or CidrIpv6 range of anywhere
-                    if (('CidrIpv4' in rule) and (rule['CidrIpv4'] == '0.0.0.0/0')) or (( 'CidrIpv6' in rule) and (rule['CidrIpv6'] == '::/0')):
-        
-                        # that allows RDP or SSH access
-                        if (rule['FromPort'] == 3389) or (rule['FromPort'] == 22):
-                            print(f"Ingress rule {rule['SecurityGroupRuleId']} opens port {rule['FromPort']} from anywhere!" )
-                            offending_ingress_rules.append(rule)
+        for rule in paginator.paginate(Filters = filters).search(_OFFENDING_INGRESS_RULES):
+            logger.info("Ingress rule %s of security group %s opens port %s from anywhere!", rule['SecurityGroupRuleId'], rule['GroupId'], rule['FromPort'])
+            offending_ingress_rules[rule['GroupId']].append(rule)
 
-            return offending_ingress_rules
-    
-        elif all_rules == []:
-            print(f"No ingress rules found on security group {groupId}")
-            return []
+        return dict(offending_ingress_rules)
     except ClientError as err:
-        print("Error connecting to the EC2 client: " + err.response['Error']['Code'] + ', Message: ' + str(err))
-        return []
+        logger.error("Error connecting to the EC2 client: %s, Message: %s", err.response['Error']['Code'], err)
+        return {}
+
+def flag_remote_access(groupId):
+    '''
+    Description: Returns a list of ingress security rules that allow access to port 3389 (RDP)/22 (SSH) from anywhere.
+    Thin wrapper around flag_remote_access_bulk() kept for single security group use. Prefer flag_remote_access_bulk() when evaluating several security groups.
+    '''
+
+    logger.debug("Processing security group: %s", groupId)
+
+    return flag_remote_access_bulk(group_ids=[groupId]).get(groupId, [])
 
 def secure_remote_access(groupId):
     '''
@@ -92,7 +122,7 @@ def secure_remote_access(groupId):
         
     
         # Get the client for the EC2 service.
-        ec2 = boto3.client('ec2')
+        ec2 = _get_ec2()
 
         # Modify the offending rules.
         try:
@@ -100,7 +130,7 @@ def secure_remote_access(groupId):
                                                        SecurityGroupRules = remediated_sg_rules)
             return remediated_sg_rules
         except ClientError as err:
-            print("Error encountered while modifying the security group rules]: " + err.response['Error']['Code'] + ', Message: ' + str(err))
+            logger.error("Error encountered while modifying the security group rules: %s, Message: %s", err.response['Error']['Code'], err)
             return []
     else:
         # No offending ingress rules found.
@@ -108,6 +138,8 @@ def secure_remote_access(groupId):
     
 
 
+logging.basicConfig(level=logging.INFO)
+
 sg_id = 'sg-09d0c55a2a08dcadb'
 
 remediated_sg_rules = secure_remote_access(groupId = sg_id)
@@ -9,11 +9,126 @@ The public buckets are listed in a Google Sheet as serialized dictionaries.
 
 import gsheets_api
 import aws_secops
-import boto3
 
 import json
+import logging
+import random
+import shelve
+import time
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from queue import Empty, Queue
+
+logger = logging.getLogger(__name__)
+
+def write_report(report_rows, service_account_file, scopes, spreadsheet_id, title, datetime_stamp, batch_size, flush_interval):
+    '''
+    Description: Consumer side of the report pipeline. Takes the serialized rows of the public buckets from the report_rows queue as they are produced
+    and appends them to the title sheet in batches. A batch is written when it reaches batch_size rows or flush_interval seconds after its first row,
+    whichever comes first, so rows reach the sheet while the evaluation is still running. A None item marks the end of the rows.
+    The sheet, its datetime stamp and its header are only created when the first batch is written, so nothing is written if there are no public buckets.
+    Returns a tuple with the number of rows written and the list of names of the buckets whose rows could not be written.
+    Parameters:
+    - report_rows: queue.Queue of rows (lists) produced by serialize_bucket_properties(mode='NORMALIZED'), terminated by None.
+    - service_account_file: path to the JSON key file of the service account used to access the Google Sheets API.
+    - scopes: list of OAuth scopes for the service account credentials.
+    - spreadsheet_id: the ID of the spreadsheet that will contain the report sheet.
+    - title: String representing the name of the report sheet to be created.
+    - datetime_stamp: list with the values written in the A1 range of the report sheet.
+    - batch_size: maximum number of rows sent to the Google Sheets API per call.
+    - flush_interval: maximum number of seconds a row waits in a batch before the batch is written.
+    '''
+    creds = None
+    rows_written = 0
+    failed_buckets = []
+    batch = []
+
+    def write_batch():
+        '''
+        Description: Writes the pending batch and returns the error of the Google Sheets API call, or None if the batch was written.
+        '''
+        nonlocal creds
+
+        if creds is None:
+            # Credentials for Google Sheets API.
+            creds = gsheets_api.load_creds(service_account_file, tuple(scopes))
+
+            # Data to be written is a list of lists (rows).
+            sheet_header_normalized=[['BucketName', 'PublicACL', 'PublicPolicy', 'Owner', 'Grants']]
+
+            # The new sheet gets an explicit ID so the cells can be written in the same request that creates it.
+            sheet_id = random.randrange(1, 2**31)
+            rows = [datetime_stamp] + sheet_header_normalized + batch
+
+            # Create new sheet for the serialized report in the existing spreadsheet, then write the datetime stamp at A1 and the sheet header
+            # and the first batch from the A2 row, with a single call.
+            # updateCells does not grow the grid (1000 rows by default), so the sheet is created with exactly as many rows as are written.
+            error = gsheets_api.batch_spreadsheet_update(creds=creds,
+                              spreadsheet_id=spreadsheet_id,
+                              requests=[
+                                  {'addSheet': {'properties': {'title': title, 'sheetId': sheet_id,
+                                                               'gridProperties': {'rowCount': len(rows), 'columnCount': len(sheet_header_normalized[0])}}}},
+                                  gsheets_api.update_cells_request(sheet_id=sheet_id, data=rows)
+                              ]
+            )
+
+            # The requests are applied atomically. If the sheet could not be added because it already exists from an earlier run nothing was written,
+            # so write the datetime stamp, the header and the first batch to the existing sheet instead. Any other error is not retried.
+            if error is not None and error.resp.status == 400 and 'already exists' in str(error):
+                error = gsheets_api.batch_update_values(creds=creds,
+                                  spreadsheet_id=spreadsheet_id,
+                                  ranges_and_values=[
+                                      (f"{title}!A1", [datetime_stamp]),
+                                      (f"{title}!A2", sheet_header_normalized + batch)
+                                  ]
+                )
+
+            # Load the credentials and create the sheet again with the next batch if the first one could not be written.
+            if error is not None:
+                creds = None
+
+            return error
+        else:
+            # Append the batch after the last row of the table that starts at the A2 row.
+            return gsheets_api.append_values(creds=creds,
+                              spreadsheet_id=spreadsheet_id,
+                              range=f"{title}!A2",
+                              insert_data_option='OVERWRITE',
+                              data=batch
+            )
+
+    finished = False
+    deadline = None
+    try:
+        while not finished:
+            # While a batch is pending, wait for the next row no longer than the batch deadline.
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                row = report_rows.get(timeout=timeout)
+                if row is None:
+                    finished = True
+                else:
+                    if not batch:
+                        deadline = time.monotonic() + flush_interval
+                    batch.append(row)
+            except Empty:
+                pass
+
+            if batch and (finished or len(batch) == batch_size or time.monotonic() >= deadline):
+                if write_batch() is None:
+                    rows_written += len(batch)
+                else:
+                    # The first column of a row is the bucket name.
+                    failed_buckets.extend(row[0] for row in batch)
+                    logger.error("%d public buckets could not be written to the %s sheet: %s", len(batch), title, ', '.join(row[0] for row in batch))
+                batch = []
+    finally:
+        # If writing failed keep draining the queue until the end marker, so the producer never blocks on a full queue.
+        while not finished:
+            finished = report_rows.get() is None
+
+    return rows_written, failed_buckets
 
 def main():
     
@@ -21,71 +136,112 @@ def main():
     scopes = ['https://www.googleapis.com/auth/spreadsheets','https://www.googleapis.com/auth/drive']
     service_account_file = 'credentials.json'
     sample_spreadsheet_id = '1z36C1xvQwrvrxyLlYIHx5wTZFt_BpOYi-q6DF_2B39g'
-    
-    bucket_properties = dict()
-    
-    # List of dictionaries.
-    public_buckets = [] 
-
-    public_bucket_report_serialized = []
-    public_buckets_report_serialized = []
+    sheet_title = 'S3 Public Buckets-SERIALIZED'
 
     now=datetime.now()
     # See the Python strftime cheatsheet https://strftime.org/ for more formatting options.
     now_str=now.strftime("%Y-%m-%d At %H:%M:%S")
 
-    # Get the service client.
-    s3 = boto3.client('s3')
+    datetime_stamp=[f'S3 Public Buckets Report - Created on {now_str}']
+
+    # Maximum number of buckets evaluated in parallel. The evaluation is network-bound, so threads spend most of their time waiting on S3.
+    # Each evaluation keeps up to two requests in flight, so 2 x max_workers must not exceed the max_pool_connections of aws_secops.CLIENT_CONFIG.
+    max_workers = 32
+
+    # The public buckets are streamed to the report writer through a bounded queue and appended to the sheet in batches of report_batch_size rows,
+    # or report_flush_interval seconds after the first row of a batch. Each write is a round-trip to the Google Sheets API, so batches are as
+    # large as possible while staying well under the request size limit, and the interval is long enough for small accounts to need a single write.
+    report_queue_size = 128
+    report_batch_size = 5000
+    report_flush_interval = 5
+
+    # Optional local cache of evaluation results for scheduled runs. Set cache_file to a file path (e.g. 's3_public_access_cache') to skip
+    # the S3 calls for buckets evaluated less than cache_max_age ago. Leave it as None to evaluate every bucket on every run.
+    cache_file = None
+    cache_max_age = timedelta(hours=24)
+
+    # Load the Google Sheets credentials in the background while S3 is queried. load_creds() caches them, so the report writer reuses them.
+    # A failure is not raised here: the report writer loads the credentials again, and reports the error, only if there is something to write.
+    creds_loader = ThreadPoolExecutor(max_workers=1)
+    creds_loader.submit(gsheets_api.load_creds, service_account_file, tuple(scopes))
+    creds_loader.shutdown(wait=False)
+
+    # If S3 Block Public Access is fully enabled for the account no bucket can be public, so there is nothing to evaluate.
+    if aws_secops.account_blocks_public_access():
+        print("S3 Block Public Access is enabled for the account, so no bucket can be public. That's actually great!")
+        return
+
+    # Get the service client. Clients are thread-safe, so a single client is shared by all the worker threads.
+    s3 = aws_secops.get_s3_client()
     response = s3.list_buckets()
 
+    cache = shelve.open(cache_file) if cache_file else {}
+
+    # Reuse a cached result only if it is recent enough and the bucket was not deleted and re-created since it was evaluated.
+    cached_bucket_properties = []
+    buckets_to_evaluate = []
     for bucket in response['Buckets']:
-        bucket_properties=aws_secops.evaluate_s3_public_access (bucket_name=bucket['Name'])
-        if bucket_properties['PublicACL'] or bucket_properties['PublicPolicy']:
-            public_buckets.append(bucket_properties)
-            
-            # Serialize each bucket_properties and convert to list.
-            public_bucket_report_serialized=aws_secops.serialize_bucket_properties(bucket_properties=bucket_properties, mode='NORMALIZED')
+        cache_entry = cache.get(bucket['Name'])
+        if cache_entry and cache_entry['CreationDate'] == bucket['CreationDate'] and now - cache_entry['EvaluatedOn'] < cache_max_age:
+            cached_bucket_properties.append(cache_entry['BucketProperties'])
+        else:
+            buckets_to_evaluate.append(bucket)
+
+    report_rows = Queue(maxsize=report_queue_size)
+
+    def report_if_public(bucket_properties):
+        if bucket_properties.public_acl or bucket_properties.public_policy:
+            logger.info("Public bucket detected: %s", bucket_properties.name)
+
+            # The full properties include the ACL grants and can be large, so they are only formatted when debug logging is enabled.
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Properties of public bucket %s: %s", bucket_properties.name, bucket_properties)
+
+            # Serialize each bucket_properties and hand the row over to the report writer.
+            report_rows.put(aws_secops.serialize_bucket_properties(bucket_properties=bucket_properties, mode='NORMALIZED'))
 
-            # Append all public_bucket_report_serialized lists to the public_buckets_report_serialized list.
-            public_buckets_report_serialized.append(public_bucket_report_serialized)
+    # The report writer appends rows to the sheet while the remaining buckets are still being evaluated.
+    with ThreadPoolExecutor(max_workers=1) as report_writer:
+        report_future = report_writer.submit(write_report, report_rows, service_account_file, scopes, sample_spreadsheet_id, sheet_title, datetime_stamp, report_batch_size, report_flush_interval)
 
-    if len(public_buckets) == 0:
+        try:
+            for bucket_properties in cached_bucket_properties:
+                report_if_public(bucket_properties)
+
+            # Evaluate the buckets in parallel and report each one as soon as its evaluation completes.
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(aws_secops.evaluate_s3_public_access, bucket_name=bucket['Name'], s3_client=s3): bucket for bucket in buckets_to_evaluate}
+
+                for future in as_completed(futures):
+                    bucket = futures[future]
+                    bucket_properties = future.result()
+
+                    # Cache the new result only if it is conclusive. A result with an ACL or policy status that could not be read would hide
+                    # a public bucket until the cache entry expires. Without a cache file nothing is kept, so memory use stays flat.
+                    if cache_file and bucket_properties.is_conclusive():
+                        cache[bucket['Name']] = {'CreationDate': bucket['CreationDate'], 'EvaluatedOn': now, 'BucketProperties': bucket_properties}
+
+                    report_if_public(bucket_properties)
+        finally:
+            # Tell the report writer there are no more rows.
+            report_rows.put(None)
+
+            if cache_file:
+                cache.close()
+
+        public_bucket_count, failed_buckets = report_future.result()
+
+    if public_bucket_count == 0 and not failed_buckets:
         print("No public buckets detected. That's actually great!")
-    else:
-        print(f'The list of public buckets is below:\n {public_buckets}')
-
-        # Credentials for Google Sheets API.
-        creds = gsheets_api.ServiceAccountCredentials.from_json_keyfile_name(
-        service_account_file,
-        scopes,
-        )
-
-        # Create new sheet for the serialized report in the existing spreadsheet.
-        gsheets_api.create_sheet(creds=creds, title='S3 Public Buckets-SERIALIZED', spreadsheet_id=sample_spreadsheet_id)
-       
-        datetime_stamp=[f'S3 Public Buckets Report - Created on {now_str}']
-
-        # Add a datetime stamp on both sheets. 
-        gsheets_api.update_sheet(creds, title = 'S3 Public Buckets-SERIALIZED', spreadsheet_id=sample_spreadsheet_id, data=datetime_stamp)
-
-        # Data to be appended by append_values is a list of lists (rows).
-        sheet_header_normalized=[['BucketName', 'PublicACL', 'PublicPolicy', 'Owner', 'Grants']]
-
-        # Append sheet header to normalized report.        
-        gsheets_api.append_values(creds=creds,
-                          spreadsheet_id=sample_spreadsheet_id,
-                          range="S3 Public Buckets-SERIALIZED!A2",
-                          insert_data_option='OVERWRITE',
-                          data=sheet_header_normalized
-        )
-        
-        # Append values contained in public_buckets_report_serialized list to the serialized sheet at A3 row.
-        gsheets_api.append_values(creds=creds,
-                          spreadsheet_id=sample_spreadsheet_id,
-                          range="S3 Public Buckets-SERIALIZED!A3",
-                          insert_data_option='OVERWRITE',
-                          data=public_buckets_report_serialized
-        )
-        
+    elif public_bucket_count:
+        print(f'{public_bucket_count} public buckets reported in the {sheet_title} sheet.')
+
+    # The buckets that could not be written to the sheet are still reported, so no public bucket goes unnoticed.
+    if failed_buckets:
+        print(f'{len(failed_buckets)} public buckets could not be written to the {sheet_title} sheet:')
+        for bucket_name in failed_buckets:
+            print(bucket_name)
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     main()
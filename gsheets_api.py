@@ -13,6 +13,30 @@ from googleapiclient.errors import HttpError
 
 from oauth2client.service_account import ServiceAccountCredentials
 
+from functools import lru_cache
+
+@lru_cache(maxsize=1)
+def load_creds(service_account_file, scopes):
+    '''
+    Description: Returns the credentials of a service account, loaded once and reused on every subsequent call with the same arguments.
+    Loading reads and parses the JSON key file and builds the RSA signing key, which is wasted work when main() runs more than once in a process.
+    Parameters:
+    - service_account_file: path to the JSON key file of the service account.
+    - scopes: tuple of OAuth scopes. A tuple is required because the arguments are used as the cache key.
+    '''
+    return ServiceAccountCredentials.from_json_keyfile_name(service_account_file, list(scopes))
+
+@lru_cache(maxsize=4)
+def _get_service(creds):
+    '''
+    Description: Returns the Google Sheets API service for the given credentials, built once per credentials object and reused by every function in this module.
+    Building the service loads and parses the Sheets discovery document, which is wasted work when repeated for every call.
+    The service is not thread-safe (httplib2), so its calls should be made from one thread at a time.
+    Parameters:
+    - creds: Credentials for a service account.
+    '''
+    return build('sheets', 'v4', credentials=creds)
+
 def get_values(creds, spreadsheet_id, range, major_dimension):
     '''
     Description: Returns a range of values from a spreadsheet.
@@ -37,7 +61,7 @@ def get_values(creds, spreadsheet_id, range, major_dimension):
     date_time_render_option = 'FORMATTED_STRING' 
 
     try:
-        service = build('sheets', 'v4', credentials=creds)
+        service = _get_service(creds)
 
         request = service.spreadsheets().values().get(
             spreadsheetId=spreadsheet_id, 
@@ -76,7 +100,7 @@ def append_values(creds, spreadsheet_id, range, insert_data_option, data):
     value_range_body = {"values":data, "majorDimension": "ROWS"}
 
     try:
-        service = build('sheets', 'v4', credentials=creds)
+        service = _get_service(creds)
 
         request = service.spreadsheets().values().append(
             spreadsheetId=spreadsheet_id, 
@@ -103,7 +127,7 @@ def create_sheet(creds,title,spreadsheet_id):
     Documentation: https://developers.google.com/sheets/api/samples/sheet
     '''   
     try:
-        service = build('sheets', 'v4', credentials=creds)
+        service = _get_service(creds)
         
         batch_update_spreadsheet_request_body = {'requests':[{'addSheet': {'properties': {'title': title}}}]}
         
@@ -115,20 +139,20 @@ def create_sheet(creds,title,spreadsheet_id):
 
 def update_sheet(creds, title, spreadsheet_id, data):
     '''
-    Description: Sets values in the Sheet!A1 range in a sheet.
+    Description: Sets values in a sheet, starting at the Sheet!A1 range. Several rows, e.g. a datetime stamp and a header row, can be written with a single call.
     Parameters: 
     - creds: Credentials for a service account. The service account used must have have Editor access to the spreadsheet.
     - title: String representing the name of the sheet to be updated.
     - spreadsheet_id: the ID of the spreadsheet that contains the sheet to be updated.
-    - data: a list of values to be written in the title.A1 range of the title sheet.
+    - data: a list of rows(lists) to be written starting at the title!A1 range of the title sheet, e.g. [['Report created on 2022-05-20'], ['Header1', 'Header2']].
     Method: spreadsheets.values.batchUpdate
     HTTP Request: POST https://sheets.googleapis.com/v4/spreadsheets/{spreadsheetId}/values:batchUpdate
     Documentation: https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/batchUpdate
     '''
     try:
-        service = build('sheets', 'v4', credentials=creds)
+        service = _get_service(creds)
         
-        batch_update_values_request_body = {"data":[{"majorDimension": "COLUMNS", "range": (title+"!A1"), "values": [data]}], "valueInputOption": "USER_ENTERED"}
+        batch_update_values_request_body = {"data":[{"majorDimension": "ROWS", "range": (title+"!A1"), "values": data}], "valueInputOption": "USER_ENTERED"}
         
         request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_values_request_body)
 
@@ -136,3 +160,83 @@ def update_sheet(creds, title, spreadsheet_id, data):
     except HttpError as error:
         print(f"An error occurred: {error}")
         return error
+
+def batch_update_values(creds, spreadsheet_id, ranges_and_values):
+    '''
+    Description: Sets values in one or more ranges of a spreadsheet with a single request.
+    Parameters: 
+    - creds: Credentials for a service account. The service account used must have have Editor access to the spreadsheet.
+    - spreadsheet_id: the ID of the spreadsheet to update.
+    - ranges_and_values: a list of (range, data) tuples, where range is the A1 notation of the range to write and data is a list of rows(lists) written starting at that range.
+    Method: spreadsheets.values.batchUpdate
+    HTTP Request: POST https://sheets.googleapis.com/v4/spreadsheets/{spreadsheetId}/values:batchUpdate
+    Documentation: https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/batchUpdate
+    '''
+    try:
+        service = _get_service(creds)
+
+        batch_update_values_request_body = {
+            "data": [{"majorDimension": "ROWS", "range": range, "values": data} for range, data in ranges_and_values],
+            "valueInputOption": "USER_ENTERED"
+        }
+
+        request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_values_request_body)
+
+        response = request.execute()
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        return error
+
+def batch_spreadsheet_update(creds, spreadsheet_id, requests):
+    '''
+    Description: Applies a list of updates to a spreadsheet with a single request. The requests are applied in order, so a sheet added by an addSheet request can be written by the requests that follow it.
+    Parameters: 
+    - creds: Credentials for a service account. The service account used must have have Editor access to the spreadsheet.
+    - spreadsheet_id: the ID of the spreadsheet to update.
+    - requests: a list of Request objects, e.g. {'addSheet': {...}} or the updateCells request returned by update_cells_request().
+    Method: spreadsheets.batchUpdate
+    HTTP Request: POST https://sheets.googleapis.com/v4/spreadsheets/{spreadsheetId}:batchUpdate
+    Documentation: https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/batchUpdate
+    '''
+    try:
+        service = _get_service(creds)
+
+        batch_update_spreadsheet_request_body = {'requests': requests}
+
+        request = service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=batch_update_spreadsheet_request_body)
+
+        response = request.execute()
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        return error
+
+def update_cells_request(sheet_id, data, row_index=0, column_index=0):
+    '''
+    Description: Returns an updateCells request, to be sent with batch_spreadsheet_update(), that writes rows of values starting at the given cell of a sheet.
+    Strings, numbers and booleans are written as such; None leaves the cell empty.
+    Parameters: 
+    - sheet_id: the numeric ID of the sheet to write to (not its title).
+    - data: a list of rows(lists) to be written.
+    - row_index: zero-based index of the first row to write. The default 0 is row 1.
+    - column_index: zero-based index of the first column to write. The default 0 is column A.
+    Documentation: https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/request#updatecellsrequest
+    '''
+    return {
+        'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': row_index, 'columnIndex': column_index},
+            'rows': [{'values': [_cell_data(value) for value in row]} for row in data],
+            'fields': 'userEnteredValue'
+        }
+    }
+
+def _cell_data(value):
+    '''
+    Description: Returns the CellData for a single value. bool is tested before numbers because bool is a subclass of int.
+    '''
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}